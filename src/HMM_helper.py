@@ -127,6 +127,18 @@ def sample_sentence(hmm, obs_map, n_words=100):
 
     return ' '.join(sentence).capitalize() + '...'
 
+def sample_sentences(hmm, obs_map, n_sentences, n_words=100):
+    # Same as sample_sentence, but draws all sentences in one call to
+    # generate_emissions.
+    obs_map_r = obs_map_reverser(obs_map)
+
+    emissions, states = hmm.generate_emissions(n_sentences, n_words)
+
+    return [
+        ' '.join([obs_map_r[i] for i in emission]).capitalize() + '...'
+        for emission in emissions
+    ]
+
 
 ####################
 # HMM VISUALIZATION FUNCTIONS
@@ -0,0 +1,180 @@
+import numpy as np
+from numba import njit
+
+
+# Numba kernels of the HMM. These are the loops of HMM_python compiled to
+# machine code, which for small numbers of states beats the per-step
+# overhead of the NumPy kernels. Compiled code is cached on disk (in
+# __pycache__) so that new processes, such as Baum-Welch workers, do not
+# compile it again. The public functions take and return the same arguments
+# as the kernels in HMM_numpy.
+
+
+@njit(cache=True)
+def _forward(A_start, A, O, x, alphas, scales):
+    M = x.shape[0]
+    L = A_start.shape[0]
+
+    for t in range(M):
+        norm = 0.
+        for curr in range(L):
+            if t == 0:
+                prob = A_start[curr]
+            else:
+                prob = 0.
+                for prev in range(L):
+                    prob += alphas[t, prev] * A[prev, curr]
+            prob *= O[curr, x[t]]
+            alphas[t + 1, curr] = prob
+            norm += prob
+
+        scales[t + 1] = norm
+        for curr in range(L):
+            alphas[t + 1, curr] /= norm
+
+
+@njit(cache=True)
+def _backward(A_start, A, O, x, scales, betas):
+    M = x.shape[0]
+    L = A_start.shape[0]
+
+    for curr in range(L):
+        betas[M, curr] = 1.
+
+    for t in range(M - 1, 0, -1):
+        for curr in range(L):
+            prob = 0.
+            for nxt in range(L):
+                prob += A[curr, nxt] * O[nxt, x[t]] * betas[t + 1, nxt]
+            betas[t, curr] = prob / scales[t + 1]
+
+    prob = 0.
+    for nxt in range(L):
+        prob += A_start[nxt] * O[nxt, x[0]] * betas[1, nxt]
+    for curr in range(L):
+        betas[0, curr] = prob / scales[1]
+
+
+@njit(cache=True)
+def _viterbi(log_A_start, log_A, log_O, x):
+    M = x.shape[0]
+    L = log_A_start.shape[0]
+    probs = log_A_start + log_O[:, x[0]]
+    new_probs = np.empty(L)
+    backpointers = np.zeros((M, L), dtype=np.int64)
+
+    for t in range(1, M):
+        for curr in range(L):
+            best = 0
+            for prev in range(1, L):
+                if probs[prev] + log_A[prev, curr] > probs[best] + log_A[best, curr]:
+                    best = prev
+            backpointers[t, curr] = best
+            new_probs[curr] = probs[best] + log_A[best, curr] + log_O[curr, x[t]]
+        probs[:] = new_probs
+
+    max_seq = np.zeros(M, dtype=np.int64)
+    max_seq[M - 1] = np.argmax(probs)
+    for t in range(M - 1, 0, -1):
+        max_seq[t - 1] = backpointers[t, max_seq[t]]
+
+    return max_seq
+
+
+@njit(cache=True)
+def _expectation(A_start, A, O, seqs, lengths, A_num, O_num, A_den, O_den):
+    L = A_start.shape[0]
+    T = seqs.shape[1]
+    alphas = np.zeros((T + 1, L), dtype=A.dtype)
+    betas = np.zeros((T + 1, L), dtype=A.dtype)
+    scales = np.ones(T + 1, dtype=A.dtype)
+    log_prob = 0.
+
+    for n in range(seqs.shape[0]):
+        M = lengths[n]
+        x = seqs[n, :M]
+        _forward(A_start, A, O, x, alphas, scales)
+        _backward(A_start, A, O, x, scales, betas)
+
+        # E: With the forward scales, alpha * beta is P(y^t = i | x).
+        for t in range(1, M + 1):
+            log_prob += np.log(scales[t])
+            for curr in range(L):
+                gamma = alphas[t, curr] * betas[t, curr]
+                if t != M:
+                    A_den[curr] += gamma
+                O_den[curr] += gamma
+                O_num[curr, x[t - 1]] += gamma
+
+        # E: P(y^t = a, y^t+1 = b | x).
+        for t in range(1, M):
+            for curr in range(L):
+                for nxt in range(L):
+                    A_num[curr, nxt] += alphas[t, curr] \
+                                        * A[curr, nxt] \
+                                        * O[nxt, x[t]] \
+                                        * betas[t + 1, nxt] \
+                                        / scales[t + 1]
+
+    return log_prob
+
+
+def forward(A_start, A, O, x):
+    '''
+    Scaled forward algorithm. See `HMM_numpy.forward`.
+    '''
+
+    x = np.asarray(x, dtype=np.int64)
+    alphas = np.zeros((len(x) + 1, len(A_start)), dtype=A.dtype)
+    scales = np.ones(len(x) + 1, dtype=A.dtype)
+    _forward(A_start, A, O, x, alphas, scales)
+
+    return alphas, scales
+
+
+def backward(A_start, A, O, x, scales):
+    '''
+    Scaled backward algorithm. See `HMM_numpy.backward`.
+    '''
+
+    x = np.asarray(x, dtype=np.int64)
+    betas = np.zeros((len(x) + 1, len(A_start)), dtype=A.dtype)
+    _backward(A_start, A, O, x, scales, betas)
+
+    return betas
+
+
+def viterbi(log_A_start, log_A, log_O, x):
+    '''
+    Log-space Viterbi algorithm. See `HMM_numpy.viterbi`.
+    '''
+
+    return _viterbi(log_A_start, log_A, log_O, np.asarray(x, dtype=np.int64))
+
+
+def viterbi_batch(log_A_start, log_A, log_O, X):
+    '''
+    Runs `viterbi` on every sequence of a dataset. See
+    `HMM_numpy.viterbi_batch`.
+    '''
+
+    return [viterbi(log_A_start, log_A, log_O, x) for x in X]
+
+
+def expectation(A_start, A, O, seqs, mask):
+    '''
+    Baum-Welch E-step, with the accumulation loops compiled. See
+    `HMM_numpy.expectation`.
+    '''
+
+    L, D = O.shape
+    A_num = np.zeros((L, L), dtype=A.dtype)
+    O_num = np.zeros((L, D), dtype=A.dtype)
+    A_den = np.zeros(L, dtype=A.dtype)
+    O_den = np.zeros(L, dtype=A.dtype)
+    log_prob = _expectation(
+        A_start, A, O, seqs.astype(np.int64), mask.sum(axis=1),
+        A_num, O_num, A_den, O_den,
+    )
+
+    return A_num, O_num, A_den, O_den, log_prob
@@ -0,0 +1,799 @@
+import numpy as np
+
+
+# NumPy kernels of the HMM, computing each time step with array operations
+# and per-step scaling, plus the array helpers used by HMM.HiddenMarkovModel
+# for sampling and syllable-constrained generation. Work buffers take the
+# dtype of A, so the kernels run in float32 when the parameters are float32.
+
+def forward(A_start, A, O, x):
+    '''
+    Scaled forward algorithm. Each alpha vector is computed as a single
+    matrix-vector product on A and a column of O, and is then divided by
+    its sum so that long sequences do not underflow.
+
+    Arguments:
+        A_start:    Starting transition probabilities as an array of length L.
+
+        A:          Transition matrix as an L x L array.
+
+        O:          Observation matrix as an L x D array.
+
+        x:          Input sequence in the form of a list of length M,
+                    consisting of integers ranging from 0 to D - 1.
+
+    Returns:
+        alphas:     (M + 1) x L array of scaled alphas. Row i sums to one
+                    for i >= 1 and row 0 is zero, as in the list version.
+
+        scales:     Array of length M + 1. scales[i] is the factor that
+                    row i was divided by, so that the product of
+                    scales[1:i + 1] times alphas[i] is the unscaled alpha.
+    '''
+
+    M = len(x)
+    alphas = np.zeros((M + 1, len(A_start)), dtype=A.dtype)
+    scales = np.ones(M + 1, dtype=A.dtype)
+
+    alpha = A_start * O[:, x[0]]
+    scales[1] = alpha.sum()
+    alphas[1] = alpha / scales[1]
+
+    for t in range(1, M):
+        alpha = alphas[t].dot(A) * O[:, x[t]]
+        scales[t + 1] = alpha.sum()
+        alphas[t + 1] = alpha / scales[t + 1]
+
+    return alphas, scales
+
+
+def backward(A_start, A, O, x, scales):
+    '''
+    Scaled backward algorithm, using the scaling factors of the forward
+    pass. With this choice alphas[i] * betas[i] is exactly the posterior
+    distribution of the state at position i.
+
+    Arguments:
+        A_start:    Starting transition probabilities as an array of length L.
+
+        A:          Transition matrix as an L x L array.
+
+        O:          Observation matrix as an L x D array.
+
+        x:          Input sequence in the form of a list of length M,
+                    consisting of integers ranging from 0 to D - 1.
+
+        scales:     Scaling factors returned by `forward`.
+
+    Returns:
+        betas:      (M + 1) x L array of scaled betas. Row i has been
+                    divided by the product of scales[i + 1:].
+    '''
+
+    M = len(x)
+    betas = np.zeros((M + 1, len(A_start)), dtype=A.dtype)
+    betas[M] = 1.
+
+    for t in range(M - 1, 0, -1):
+        betas[t] = A.dot(O[:, x[t]] * betas[t + 1]) / scales[t + 1]
+
+    # As in the list version, beta(0) uses the starting probabilities and
+    # is the same for every state.
+    betas[0] = (A_start * O[:, x[0]]).dot(betas[1]) / scales[1]
+
+    return betas
+
+
+def pad_sequences(X):
+    '''
+    Packs a list of variable-length sequences into a single padded array.
+
+    Arguments:
+        X:          A dataset consisting of input sequences in the form
+                    of lists of variable length, consisting of integers
+                    ranging from 0 to D - 1. In other words, a list of lists.
+
+    Returns:
+        seqs:       N x T integer array, where T is the length of the
+                    longest sequence. Padding positions are zero.
+
+        mask:       N x T boolean array that is True where seqs holds an
+                    observation and False where it holds padding.
+    '''
+
+    lengths = np.array([len(x) for x in X])
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    seqs = np.zeros(mask.shape, dtype=int)
+    seqs[mask] = np.concatenate([np.asarray(x, dtype=int) for x in X])
+
+    return seqs, mask
+
+
+def unflatten_sequences(tokens, offsets):
+    '''
+    Packs sequences stored as one flat token array into a padded array, as
+    `pad_sequences` does.
+
+    Arguments:
+        tokens:     Integer array of the concatenated sequences.
+
+        offsets:    Integer array of length N + 1. Sequence i is
+                    tokens[offsets[i]:offsets[i + 1]].
+
+    Returns:
+        seqs:       N x T padded integer array.
+
+        mask:       N x T boolean mask.
+    '''
+
+    lengths = np.diff(offsets)
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    seqs = np.zeros(mask.shape, dtype=int)
+    seqs[mask] = tokens[offsets[0]:offsets[-1]]
+
+    return seqs, mask
+
+
+def log(a):
+    '''
+    Elementwise natural log that maps zero probabilities to -inf without
+    emitting a warning.
+    '''
+
+    with np.errstate(divide='ignore'):
+        return np.log(a)
+
+
+def viterbi(log_A_start, log_A, log_O, x):
+    '''
+    Log-space Viterbi algorithm. The best previous state for every current
+    state is found with a single max/argmax over an L x L array, and is
+    stored as an integer backpointer.
+
+    Arguments:
+        log_A_start:    Log starting probabilities as an array of length L.
+
+        log_A:          Log transition matrix as an L x L array.
+
+        log_O:          Log observation matrix as an L x D array.
+
+        x:              Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+    Returns:
+        max_seq:        Integer array of length M with the most probable
+                        state sequence.
+    '''
+
+    M = len(x)
+    L = len(log_A_start)
+    backpointers = np.zeros((M, L), dtype=int)
+
+    probs = log_A_start + log_O[:, x[0]]
+    for t in range(1, M):
+        # The (prev, curr)^th element is the log probability of the best
+        # prefix ending in prev followed by a transition to curr.
+        cands = probs[:, None] + log_A
+        backpointers[t] = cands.argmax(axis=0)
+        probs = cands[backpointers[t], np.arange(L)] + log_O[:, x[t]]
+
+    max_seq = np.zeros(M, dtype=int)
+    max_seq[-1] = probs.argmax()
+    for t in range(M - 1, 0, -1):
+        max_seq[t - 1] = backpointers[t, max_seq[t]]
+
+    return max_seq
+
+
+def viterbi_batch(log_A_start, log_A, log_O, X):
+    '''
+    Runs `viterbi` on every sequence of a dataset at once. The sequences
+    are padded to a common length and every time step is processed for the
+    whole batch with one N x L x L max/argmax. At padding positions the
+    probabilities are carried over and the backpointers are the identity,
+    so that backtracking from the end of the padded array recovers each
+    sequence's own path.
+
+    Arguments:
+        log_A_start:    Log starting probabilities as an array of length L.
+
+        log_A:          Log transition matrix as an L x L array.
+
+        log_O:          Log observation matrix as an L x D array.
+
+        X:              A dataset consisting of input sequences in the form
+                        of lists of variable length, consisting of integers
+                        ranging from 0 to D - 1. In other words, a list of
+                        lists.
+
+    Returns:
+        max_seqs:       List of integer arrays with the most probable state
+                        sequence of each element of X.
+    '''
+
+    seqs, mask = pad_sequences(X)
+    N, T = seqs.shape
+    L = len(log_A_start)
+    states = np.arange(L)
+    backpointers = np.zeros((N, T, L), dtype=int)
+    backpointers[:] = states
+
+    probs = log_A_start + log_O[:, seqs[:, 0]].T
+    for t in range(1, T):
+        cands = probs[:, :, None] + log_A
+        best = cands.argmax(axis=1)
+        new_probs = np.take_along_axis(cands, best[:, None, :], axis=1)[:, 0]
+        new_probs += log_O[:, seqs[:, t]].T
+
+        active = mask[:, t]
+        backpointers[active, t] = best[active]
+        probs[active] = new_probs[active]
+
+    paths = np.zeros((N, T), dtype=int)
+    paths[:, -1] = probs.argmax(axis=1)
+    rows = np.arange(N)
+    for t in range(T - 1, 0, -1):
+        paths[:, t - 1] = backpointers[rows, t, paths[:, t]]
+
+    return [path[m] for path, m in zip(paths, mask)]
+
+
+def viterbi_top_k(log_A_start, log_A, log_O, x, k):
+    '''
+    List Viterbi algorithm. Keeps the k best prefixes ending in each state
+    instead of only the best one, so that the k most probable state
+    sequences can be backtracked at the end. Each step selects the k best
+    of the L * k candidate prefixes of every current state at once.
+
+    Arguments:
+        log_A_start:    Log starting probabilities as an array of length L.
+
+        log_A:          Log transition matrix as an L x L array.
+
+        log_O:          Log observation matrix as an L x D array.
+
+        x:              Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        k:              Number of state sequences to find.
+
+    Returns:
+        max_seqs:       K x M integer array of the K most probable state
+                        sequences, most probable first. K is k, or fewer if
+                        fewer sequences have non-zero probability.
+
+        log_probs:      Array of length K with the joint log probability of
+                        each sequence and x.
+    '''
+
+    M = len(x)
+    L = len(log_A_start)
+
+    # The (i, r)^th element of probs is the log probability of the r^th best
+    # prefix ending in state i. Each backpointer is the (state, rank) of the
+    # prefix it extends, flattened to state * k + rank.
+    probs = np.full((L, k), -np.inf)
+    probs[:, 0] = log_A_start + log_O[:, x[0]]
+    backpointers = np.zeros((M, L, k), dtype=int)
+
+    for t in range(1, M):
+        # The (curr, prev * k + r)^th element extends the r^th best prefix
+        # ending in prev with a transition to curr.
+        cands = (log_A.T[:, :, None] + probs).reshape(L, L * k)
+        best = np.argpartition(-cands, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(cands, best, axis=1)
+        order = np.argsort(-top, axis=1, kind='stable')
+        backpointers[t] = np.take_along_axis(best, order, axis=1)
+        probs = np.take_along_axis(top, order, axis=1) + log_O[:, x[t], None]
+
+    flat = probs.ravel()
+    ends = np.argsort(-flat, kind='stable')[:k]
+    ends = ends[np.isfinite(flat[ends])]
+
+    max_seqs = np.zeros((len(ends), M), dtype=int)
+    for n, end in enumerate(ends):
+        state, rank = divmod(end, k)
+        for t in range(M - 1, -1, -1):
+            max_seqs[n, t] = state
+            state, rank = divmod(backpointers[t, state, rank], k)
+
+    return max_seqs, flat[ends]
+
+
+def viterbi_beam(log_A_start, log_A, log_O, x, beam):
+    '''
+    Beam-pruned Viterbi algorithm. Only the beam most probable states of
+    each step are extended, so each step costs O(L * beam) instead of
+    O(L^2). The result is the most probable state sequence whenever its
+    prefixes stay within the beam, which is always the case if beam >= L.
+
+    Arguments:
+        log_A_start:    Log starting probabilities as an array of length L.
+
+        log_A:          Log transition matrix as an L x L array.
+
+        log_O:          Log observation matrix as an L x D array.
+
+        x:              Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        beam:           Number of states kept at each step.
+
+    Returns:
+        max_seq:        Integer array of length M with the most probable
+                        state sequence found.
+    '''
+
+    M = len(x)
+    L = len(log_A_start)
+    beam = min(beam, L)
+    states = np.arange(L)
+    backpointers = np.zeros((M, L), dtype=int)
+
+    probs = log_A_start + log_O[:, x[0]]
+    for t in range(1, M):
+        kept = np.argpartition(-probs, beam - 1)[:beam]
+
+        # The (i, curr)^th element is the log probability of the best
+        # prefix ending in kept[i] followed by a transition to curr.
+        cands = probs[kept, None] + log_A[kept]
+        best = cands.argmax(axis=0)
+        backpointers[t] = kept[best]
+        probs = cands[best, states] + log_O[:, x[t]]
+
+    max_seq = np.zeros(M, dtype=int)
+    max_seq[-1] = probs.argmax()
+    for t in range(M - 1, 0, -1):
+        max_seq[t - 1] = backpointers[t, max_seq[t]]
+
+    return max_seq
+
+
+class SparseEmissions:
+    '''
+    Observation matrix stored in compressed sparse row (CSR) form: for each
+    state, only the observations it emits with non-zero probability. The
+    entries of state i are indices[indptr[i]:indptr[i + 1]] with
+    probabilities data[indptr[i]:indptr[i + 1]]. A column-ordered index of
+    the same entries is kept for looking up the states that emit a given
+    observation.
+    '''
+
+    def __init__(self, indptr, indices, data, D):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.L = len(indptr) - 1
+        self.D = D
+        self.shape = (self.L, D)
+
+        # The state of every entry, and the entries sorted by observation.
+        self.rows = np.repeat(np.arange(self.L), np.diff(indptr))
+        self.col_entries = np.argsort(indices, kind='stable')
+        self.colptr = np.append(0, np.cumsum(np.bincount(indices, minlength=D)))
+
+
+    # The cumulative sums of data used by `sample` are computed on first use
+    # and dropped whenever data is assigned.
+
+    @property
+    def data(self):
+        return self._data
+
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._cumsums = None
+
+
+    @classmethod
+    def from_dense(cls, O, threshold=0.):
+        '''
+        Builds the CSR form of an L x D observation matrix, dropping the
+        entries below threshold and renormalizing the rows. The largest
+        entry of each row and of each column is always kept, so that every
+        state emits some observation and every observation that could be
+        emitted still can be.
+        '''
+
+        keep = (O > 0) & (O >= threshold)
+        keep[np.arange(O.shape[0]), O.argmax(axis=1)] = True
+        keep[O.argmax(axis=0), np.arange(O.shape[1])] |= O.max(axis=0) > 0
+        rows, cols = np.nonzero(keep)
+        data = O[rows, cols]
+        indptr = np.append(0, np.cumsum(keep.sum(axis=1)))
+
+        return cls(indptr, cols, data, O.shape[1]).normalized()
+
+
+    def with_data(self, data, threshold=0.):
+        '''
+        Returns a matrix with the same entries holding new probabilities,
+        pruned at threshold and renormalized as in `from_dense`.
+        '''
+
+        row_max = np.zeros(self.L)
+        col_max = np.zeros(self.D)
+        np.maximum.at(row_max, self.rows, data)
+        np.maximum.at(col_max, self.indices, data)
+        keep = (data > 0) & (
+            (data >= threshold)
+            | (data == row_max[self.rows])
+            | (data == col_max[self.indices])
+        )
+
+        indptr = np.append(0, np.cumsum(np.bincount(self.rows[keep], minlength=self.L)))
+        return SparseEmissions(indptr, self.indices[keep], data[keep], self.D).normalized()
+
+
+    def normalized(self):
+        '''
+        Returns the matrix with each row rescaled to sum to one.
+        '''
+
+        totals = np.bincount(self.rows, weights=self.data, minlength=self.L)
+        self.data = self.data / totals[self.rows]
+        return self
+
+
+    def toarray(self):
+        '''
+        Returns the dense L x D matrix.
+        '''
+
+        O = np.zeros(self.shape, dtype=self.data.dtype)
+        O[self.rows, self.indices] = self.data
+        return O
+
+
+    def column(self, j):
+        '''
+        Returns column j, the probability of each state emitting
+        observation j, as a dense array of length L.
+        '''
+
+        return self.columns(np.array([j]))[:, 0]
+
+
+    def columns(self, tokens):
+        '''
+        Returns the columns of the given observations as a dense
+        L x len(tokens) array.
+        '''
+
+        positions, entries = self.column_entries(tokens)
+        cols = np.zeros((self.L, len(tokens)), dtype=self.data.dtype)
+        cols[self.rows[entries], positions] = self.data[entries]
+        return cols
+
+
+    def column_entries(self, tokens):
+        '''
+        Finds the entries of the columns of the given observations.
+
+        Returns:
+            positions:  For each entry found, the index into tokens of the
+                        observation it belongs to.
+
+            entries:    The index of each entry into indices and data.
+        '''
+
+        starts = self.colptr[tokens]
+        counts = self.colptr[tokens + 1] - starts
+        positions = np.repeat(np.arange(len(tokens)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        entries = self.col_entries[np.repeat(starts, counts) + offsets]
+
+        return positions, entries
+
+
+    def sample(self, states, rng):
+        '''
+        Draws one observation for each of the given states, by binary
+        search over the cumulative probabilities of the state's entries,
+        so the cost per draw is logarithmic in the number of entries.
+        '''
+
+        if self._cumsums is None:
+            self._cumsums = np.cumsum(self.data, dtype=float)
+        cumsums = self._cumsums
+        lo = self.indptr[states]
+        hi = self.indptr[states + 1]
+        base = np.where(lo > 0, cumsums[lo - 1], 0.)
+        targets = base + rng.random(len(states)) * (cumsums[hi - 1] - base)
+        i = np.clip(np.searchsorted(cumsums, targets, side='right'), lo, hi - 1)
+
+        return self.indices[i]
+
+
+def batch_emissions(O, seqs, mask):
+    '''
+    Looks up the emission probabilities of every observation of a padded
+    batch of sequences.
+
+    Arguments:
+        O:          Observation matrix as an L x D array or as
+                    `SparseEmissions`.
+
+        seqs:       N x T padded integer array from `pad_sequences`.
+
+        mask:       N x T boolean mask from `pad_sequences`.
+
+    Returns:
+        emissions:  N x T x L array. The (n, t, i)^th element is the
+                    probability that state i emits seqs[n, t].
+    '''
+
+    if not isinstance(O, SparseEmissions):
+        return O.T[seqs]
+
+    positions, entries = O.column_entries(seqs[mask])
+    tokens = np.zeros((mask.sum(), O.L), dtype=O.data.dtype)
+    tokens[positions, O.rows[entries]] = O.data[entries]
+    emissions = np.zeros(seqs.shape + (O.L,), dtype=O.data.dtype)
+    emissions[mask] = tokens
+
+    return emissions
+
+
+def forward_batch(A_start, A, emissions, mask):
+    '''
+    Scaled forward algorithm over a padded batch of sequences. Every time
+    step is computed for the whole batch with one N x L by L x L product.
+
+    Arguments:
+        A_start:    Starting transition probabilities as an array of length L.
+
+        A:          Transition matrix as an L x L array.
+
+        emissions:  N x T x L emission probabilities from `batch_emissions`.
+
+        mask:       N x T boolean mask from `pad_sequences`.
+
+    Returns:
+        alphas:     N x T x L array of scaled alphas. Unlike `forward` there
+                    is no empty row 0, so alphas[n, t] corresponds to
+                    observation seqs[n, t]. Rows at padding are zero.
+
+        scales:     N x T array of scaling factors. Entries at padding are
+                    one, so the sum of their logs is the log-likelihood.
+    '''
+
+    N, T = mask.shape
+    alphas = np.zeros((N, T, len(A_start)), dtype=A.dtype)
+    scales = np.ones((N, T), dtype=A.dtype)
+
+    alpha = A_start * emissions[:, 0]
+    for t in range(T):
+        if t > 0:
+            alpha = alphas[:, t - 1].dot(A) * emissions[:, t]
+        active = mask[:, t]
+        scales[active, t] = alpha[active].sum(axis=1)
+        alphas[active, t] = alpha[active] / scales[active, t, None]
+
+    return alphas, scales
+
+
+def backward_batch(A, emissions, mask, scales):
+    '''
+    Scaled backward algorithm over a padded batch of sequences, using the
+    scaling factors of `forward_batch`.
+
+    Arguments:
+        A:          Transition matrix as an L x L array.
+
+        emissions:  N x T x L emission probabilities from `batch_emissions`.
+
+        mask:       N x T boolean mask from `pad_sequences`.
+
+        scales:     Scaling factors returned by `forward_batch`.
+
+    Returns:
+        betas:      N x T x L array of scaled betas, aligned with the alphas
+                    of `forward_batch`. Rows at the last observation of
+                    each sequence and at padding are one.
+    '''
+
+    N, T = mask.shape
+    betas = np.ones((N, T, A.shape[0]), dtype=A.dtype)
+
+    for t in range(T - 2, -1, -1):
+        active = mask[:, t + 1]
+        beta = (emissions[active, t + 1] * betas[active, t + 1]).dot(A.T)
+        betas[active, t] = beta / scales[active, t + 1, None]
+
+    return betas
+
+
+def expectation(A_start, A, O, seqs, mask):
+    '''
+    Baum-Welch E-step over a padded batch of sequences. Computes the
+    sufficient statistics of the M-step for the whole batch at once.
+
+    Arguments:
+        A_start:    Starting transition probabilities as an array of length L.
+
+        A:          Transition matrix as an L x L array.
+
+        O:          Observation matrix as an L x D array or as
+                    `SparseEmissions`.
+
+        seqs:       N x T padded integer array from `pad_sequences`.
+
+        mask:       N x T boolean mask from `pad_sequences`.
+
+    Returns:
+        A_num:      L x L array of expected transition counts.
+
+        O_num:      L x D array of expected emission counts. If O is
+                    `SparseEmissions`, the counts of its entries instead,
+                    aligned with O.data. Other counts are zero since their
+                    states cannot emit the observation.
+
+        A_den:      Expected number of times each state is left, i.e. is
+                    occupied at any position but the last of a sequence.
+
+        O_den:      Expected number of times each state is occupied.
+
+        log_prob:   Total log-likelihood of the batch.
+    '''
+
+    L, D = O.shape
+    emissions = batch_emissions(O, seqs, mask)
+    alphas, scales = forward_batch(A_start, A, emissions, mask)
+    betas = backward_batch(A, emissions, mask, scales)
+
+    # E: P(y^t = i | x) is exactly alpha * beta with the forward scales.
+    gammas = alphas * betas
+    gammas[~mask] = 0.
+
+    O_den = gammas.sum(axis=(0, 1))
+    A_den = gammas[:, :-1][mask[:, 1:]].sum(axis=0)
+
+    # E: Scatter the gammas into the columns of the observed words.
+    tokens = seqs[mask]
+    token_gammas = gammas[mask]
+    if isinstance(O, SparseEmissions):
+        positions, entries = O.column_entries(tokens)
+        O_num = np.bincount(
+            entries,
+            weights=token_gammas[positions, O.rows[entries]],
+            minlength=len(O.data),
+        ).astype(A.dtype)
+    else:
+        O_num = np.array([
+            np.bincount(tokens, weights=token_gammas[:, curr], minlength=D)
+            for curr in range(L)
+        ], dtype=A.dtype)
+
+    # E: Summing P(y^t = a, y^t+1 = b | x) over t and sequences reduces to
+    # a single L x (N * T) by (N * T) x L product.
+    nxt = emissions[:, 1:] * betas[:, 1:] / scales[:, 1:, None]
+    nxt[~mask[:, 1:]] = 0.
+    A_num = A * alphas[:, :-1].reshape(-1, L).T.dot(nxt.reshape(-1, L))
+
+    # The log-likelihood is summed in double precision whatever the dtype.
+    log_prob = np.log(scales).sum(dtype=float)
+
+    return A_num, O_num, A_den, O_den, log_prob
+
+
+def sampling_table(P):
+    '''
+    Builds a table for drawing from every row of a matrix of probability
+    distributions: the cumulative sums of each row, offset by the row
+    index and flattened, so that row i spans [i, i + 1). A draw from any
+    rows is then one binary search; see `sample_rows`. The table is built
+    with array operations and takes as much memory as P.
+
+    Arguments:
+        P:          N x K array whose rows are probability distributions.
+
+    Returns:
+        table:      Float array of length N * K.
+    '''
+
+    N, K = P.shape
+    cumsums = np.cumsum(P, axis=1, dtype=float)
+    cumsums /= cumsums[:, -1:]
+    return (cumsums + np.arange(N)[:, None]).ravel()
+
+
+def sample_rows(table, K, rows, u):
+    '''
+    Draws one column from each of the given rows of a table built by
+    `sampling_table` for an N x K matrix, using the uniform numbers u in
+    [0, 1), one per row.
+    '''
+
+    rows = np.asarray(rows)
+    i = np.searchsorted(table, rows + u, side='right') - rows * K
+    return np.minimum(i, K - 1)
+
+
+def syllable_mass(O, counts):
+    '''
+    Groups the words of the vocabulary by syllable count.
+
+    Arguments:
+        O:          Observation matrix as `SparseEmissions`.
+
+        counts:     Integer array of length D with the syllable count of
+                    each word, or 0 if the word has no known count.
+
+    Returns:
+        mass:       L x (K + 1) array, where K is the largest count. The
+                    (i, k)^th element is the probability that state i emits
+                    a word of k syllables. Column 0 is left at zero.
+
+        buckets:    List of length K + 1. buckets[k] holds the entries of O
+                    whose words have k syllables, in CSR form: the row
+                    pointers, the word ids and the cumulative sums of their
+                    probabilities within each row, used by `sample_bucket`.
+    '''
+
+    K = counts.max()
+    entry_counts = counts[O.indices]
+    mass = np.bincount(
+        O.rows * (K + 1) + entry_counts, weights=O.data, minlength=O.L * (K + 1)
+    ).reshape(O.L, K + 1)
+    mass[:, 0] = 0.
+    buckets = [None]
+
+    for k in range(1, K + 1):
+        keep = entry_counts == k
+        rows = O.rows[keep]
+        indptr = np.append(0, np.cumsum(np.bincount(rows, minlength=O.L)))
+        cumsums = np.cumsum(O.data[keep])
+        # Restart the cumulative sums at the start of each row.
+        cumsums -= np.repeat(np.append(0., cumsums)[indptr[:-1]], np.diff(indptr))
+        buckets.append((indptr, O.indices[keep], cumsums))
+
+    return mass, buckets
+
+
+def sample_bucket(buckets, k, state):
+    '''
+    Draws a word with k syllables from the given state, with probability
+    proportional to its emission probability.
+    '''
+
+    indptr, words, cumsums = buckets[k]
+    lo, hi = indptr[state], indptr[state + 1]
+    row = cumsums[lo:hi]
+    i = np.searchsorted(row, np.random.random() * row[-1], side='right')
+    return words[lo + min(i, hi - lo - 1)]
+
+
+def syllable_paths(R, mass, n):
+    '''
+    Backward-filtering pass of the syllable-constrained sampler. A line is
+    generated from its last word to its first: from the current state, the
+    state of the previous word is drawn from the reverse transition matrix
+    R and a word is drawn from that state.
+
+    Arguments:
+        R:          L x L reverse transition matrix. The (i, j)^th element
+                    is the probability that the word before one emitted by
+                    state i is emitted by state j.
+
+        mass:       Syllable masses from `syllable_mass`.
+
+        n:          Largest number of syllables to fill.
+
+    Returns:
+        Z:          L x (n + 1) array. The (i, r)^th element is the
+                    probability that, going back from state i, the words
+                    drawn add up to exactly r syllables.
+    '''
+
+    K = mass.shape[1] - 1
+    Z = np.zeros((mass.shape[0], n + 1))
+    Z[:, 0] = 1.
+
+    for r in range(1, n + 1):
+        ks = np.arange(1, min(K, r) + 1)
+        Z[:, r] = R.dot((mass[:, ks] * Z[:, r - ks]).sum(axis=1))
+
+    return Z
@@ -0,0 +1,233 @@
+import numpy as np
+
+
+# Pure-Python reference implementations of the HMM kernels. They follow the
+# original list-of-lists loops over every pair of states, and take and
+# return the same arguments as the kernels in HMM_numpy, so they can be used
+# as a correctness oracle for the fast backends. The loops run on Python
+# floats; the returned arrays are converted to the dtype of A.
+
+
+def forward(A_start, A, O, x):
+    '''
+    Scaled forward algorithm. See `HMM_numpy.forward`.
+    '''
+
+    dtype = A.dtype
+    A_start, A, O = list(A_start), A.tolist(), O.tolist()
+    M = len(x)      # Length of sequence.
+    L = len(A_start)
+    alphas = [[0. for _ in range(L)] for _ in range(M + 1)]
+    scales = [1. for _ in range(M + 1)]
+
+    # Calculate alpha_j(1) for all j's.
+    for curr in range(L):
+        alphas[1][curr] = A_start[curr] * O[curr][x[0]]
+
+    # Calculate alphas throughout sequence.
+    for t in range(M):
+        if t > 0:
+            # Iterate over all possible current states.
+            for curr in range(L):
+                prob = 0
+
+                # Iterate over all possible previous states to accumulate
+                # the probabilities of all paths from the start state to
+                # the current state.
+                for prev in range(L):
+                    prob += alphas[t][prev] \
+                            * A[prev][curr] \
+                            * O[curr][x[t]]
+
+                # Store the accumulated probability.
+                alphas[t + 1][curr] = prob
+
+        norm = sum(alphas[t + 1])
+        scales[t + 1] = norm
+        for curr in range(L):
+            alphas[t + 1][curr] /= norm
+
+    return np.array(alphas, dtype=dtype), np.array(scales, dtype=dtype)
+
+
+def backward(A_start, A, O, x, scales):
+    '''
+    Scaled backward algorithm. See `HMM_numpy.backward`.
+    '''
+
+    dtype = A.dtype
+    A_start, A, O = list(A_start), A.tolist(), O.tolist()
+    M = len(x)      # Length of sequence.
+    L = len(A_start)
+    betas = [[0. for _ in range(L)] for _ in range(M + 1)]
+
+    # Initialize initial betas.
+    for curr in range(L):
+        betas[-1][curr] = 1.
+
+    # Calculate betas throughout sequence.
+    for t in range(-1, -M - 1, -1):
+        # Iterate over all possible current states.
+        for curr in range(L):
+            prob = 0
+
+            # Iterate over all possible next states to accumulate
+            # the probabilities of all paths from the end state to
+            # the current state.
+            for nxt in range(L):
+                if t == -M:
+                    prob += betas[t][nxt] \
+                            * A_start[nxt] \
+                            * O[nxt][x[t]]
+
+                else:
+                    prob += betas[t][nxt] \
+                            * A[curr][nxt] \
+                            * O[nxt][x[t]]
+
+            # Store the accumulated probability, scaled by the forward
+            # scaling factor of the next position.
+            betas[t - 1][curr] = prob / scales[t]
+
+    return np.array(betas, dtype=dtype)
+
+
+def viterbi(log_A_start, log_A, log_O, x):
+    '''
+    Log-space Viterbi algorithm. See `HMM_numpy.viterbi`.
+    '''
+
+    log_A_start, log_A, log_O = list(log_A_start), log_A.tolist(), log_O.tolist()
+    M = len(x)      # Length of sequence.
+    L = len(log_A_start)
+
+    # The (i, j)^th elements of probs and seqs are the max log probability
+    # of the prefix of length i ending in state j and the prefix that gives
+    # this probability, respectively.
+    probs = [[0. for _ in range(L)] for _ in range(M + 1)]
+    seqs = [[[] for _ in range(L)] for _ in range(M + 1)]
+
+    # Calculate initial prefixes and probabilities.
+    for curr in range(L):
+        probs[1][curr] = log_A_start[curr] + log_O[curr][x[0]]
+        seqs[1][curr] = [curr]
+
+    # Calculate best prefixes and probabilities throughout sequence.
+    for t in range(2, M + 1):
+        # Iterate over all possible current states.
+        for curr in range(L):
+            max_prob = float("-inf")
+            max_prefix = seqs[t - 1][0]
+
+            # Iterate over all possible previous states to find one
+            # that would maximize the probability of the current state.
+            for prev in range(L):
+                curr_prob = probs[t - 1][prev] \
+                            + log_A[prev][curr] \
+                            + log_O[curr][x[t - 1]]
+
+                # Continually update max probability and prefix. Ties go
+                # to the first state, as with argmax.
+                if curr_prob > max_prob:
+                    max_prob = curr_prob
+                    max_prefix = seqs[t - 1][prev]
+
+            # Store the max probability and prefix.
+            probs[t][curr] = max_prob
+            seqs[t][curr] = max_prefix + [curr]
+
+    # Find the index of the max probability of a sequence ending in x^M
+    # and the corresponding output sequence.
+    max_i = max(range(L), key=lambda i: (probs[-1][i], -i))
+    return np.array(seqs[-1][max_i])
+
+
+def viterbi_batch(log_A_start, log_A, log_O, X):
+    '''
+    Runs `viterbi` on every sequence of a dataset. See
+    `HMM_numpy.viterbi_batch`.
+    '''
+
+    return [viterbi(log_A_start, log_A, log_O, x) for x in X]
+
+
+def expectation(A_start, A, O, seqs, mask):
+    '''
+    Baum-Welch E-step, one sequence and one pair of states at a time. See
+    `HMM_numpy.expectation`.
+    '''
+
+    L, D = O.shape
+    A_list = A.tolist()
+    O_list = O.tolist()
+
+    # Numerator and denominator for the update terms of A and O.
+    A_num = [[0. for i in range(L)] for j in range(L)]
+    O_num = [[0. for i in range(D)] for j in range(L)]
+    A_den = [0. for i in range(L)]
+    O_den = [0. for i in range(L)]
+    log_prob = 0.
+
+    # For each input sequence:
+    for seq, m in zip(seqs, mask):
+        x = seq[m].tolist()
+        M = len(x)
+        # Compute the alpha and beta probability vectors.
+        alphas, scales = forward(A_start, A, O, x)
+        betas = backward(A_start, A, O, x, scales)
+        alphas = alphas.tolist()
+        betas = betas.tolist()
+        for t in range(1, M + 1):
+            log_prob += np.log(scales[t])
+
+        # E: Update the expected observation probabilities for a
+        # given (x, y).
+        # The i^th index is P(y^t = i, x).
+        for t in range(1, M + 1):
+            P_curr = [0. for _ in range(L)]
+
+            for curr in range(L):
+                P_curr[curr] = alphas[t][curr] * betas[t][curr]
+
+            # Normalize the probabilities.
+            norm = sum(P_curr)
+            for curr in range(len(P_curr)):
+                P_curr[curr] /= norm
+
+            for curr in range(L):
+                if t != M:
+                    A_den[curr] += P_curr[curr]
+                O_den[curr] += P_curr[curr]
+                O_num[curr][x[t - 1]] += P_curr[curr]
+
+        # E: Update the expectedP(y^j = a, y^j+1 = b, x) for given (x, y)
+        for t in range(1, M):
+            P_curr_nxt = [[0. for _ in range(L)] for _ in range(L)]
+
+            for curr in range(L):
+                for nxt in range(L):
+                    P_curr_nxt[curr][nxt] = alphas[t][curr] \
+                                            * A_list[curr][nxt] \
+                                            * O_list[nxt][x[t]] \
+                                            * betas[t + 1][nxt]
+
+            # Normalize:
+            norm = 0
+            for lst in P_curr_nxt:
+                norm += sum(lst)
+            for curr in range(L):
+                for nxt in range(L):
+                    P_curr_nxt[curr][nxt] /= norm
+
+            # Update A_num
+            for curr in range(L):
+                for nxt in range(L):
+                    A_num[curr][nxt] += P_curr_nxt[curr][nxt]
+
+    return (
+        np.array(A_num, dtype=A.dtype),
+        np.array(O_num, dtype=A.dtype),
+        np.array(A_den, dtype=A.dtype),
+        np.array(O_den, dtype=A.dtype),
+        log_prob,
+    )
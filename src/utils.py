@@ -1,8 +1,14 @@
+import glob
+import gzip
+import hashlib
 import os
 import pickle
 import re
+import tempfile
+from itertools import islice
 
 import nltk
+import numpy as np
 
 # Paths to text files
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -11,6 +17,7 @@ MODELS_DIR = os.path.join(ROOT_DIR, 'models')
 SHAKESPEARE_PATH = os.path.join(DATA_DIR, 'shakespeare.txt')
 SPENSER_PATH = os.path.join(DATA_DIR, 'spenser.txt')
 SYLLABLE_PATH = os.path.join(DATA_DIR, 'Syllable_dictionary.txt')
+SYLLABLE_CACHE_PATH = os.path.join(DATA_DIR, 'Syllable_dictionary.pkl')
 
 SHAKESPEARE_PARSER = re.compile(r'\s{19}[0-9]+\n(?P<sonnet>.+?)(?:\n\n\n|$)', re.DOTALL)
 SPENSER_PARSER = re.compile(r'[IVXL]+\n\n(?P<sonnet>.+?)(?:\n\n|$)', re.DOTALL)
@@ -34,6 +41,50 @@ def load_pickle(path):
     with open(path, 'rb') as f:
         return pickle.load(f)
 
+def save_sequence_shards(sequences, directory, shard_size=10000):
+    """Save encoded sequences (i.e. the output of
+    `preprocessing.create_sequences_sonnets`) to the given directory as shards
+    of `shard_size` sequences. `sequences` may be any iterable, so the whole
+    corpus never needs to be in memory.
+
+    Each shard `i` is two .npy files: `shard_i.tokens.npy`, a flat array of the
+    concatenated sequences, and `shard_i.offsets.npy`, where sequence `j`
+    of the shard is `tokens[offsets[j]:offsets[j + 1]]`.
+
+    Shards already in the directory are removed first, so that
+    `load_sequence_shards` only sees the sequences saved by this call.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for pattern in ('shard_*.tokens.npy', 'shard_*.offsets.npy'):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(path)
+    sequences = iter(sequences)
+    i = 0
+    while True:
+        shard = list(islice(sequences, shard_size))
+        if not shard:
+            break
+        offsets = np.cumsum([0] + [len(seq) for seq in shard])
+        tokens = np.fromiter(
+            (token for seq in shard for token in seq), dtype=np.int32, count=offsets[-1]
+        )
+        prefix = os.path.join(directory, 'shard_{:05d}'.format(i))
+        np.save(prefix + '.tokens.npy', tokens)
+        np.save(prefix + '.offsets.npy', offsets)
+        i += 1
+
+def load_sequence_shards(directory):
+    """Iterate over the shards saved with `save_sequence_shards` in the given
+    directory, in order. Yields `(tokens, offsets)` pairs of read-only
+    memory-mapped arrays, so only the shard in use is paged in.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, 'shard_*.tokens.npy'))):
+        prefix = path[:-len('.tokens.npy')]
+        yield (
+            np.load(prefix + '.tokens.npy', mmap_mode='r'),
+            np.load(prefix + '.offsets.npy', mmap_mode='r'),
+        )
+
 def load_shakespeare():
     """Load shakespeare.txt. Returns a list of lists.
     The outer list contains sonnets, the inner list contains lines.
@@ -62,11 +113,191 @@ def load_spenser():
         for sonnet in SPENSER_PARSER.findall(text)
     ]
 
+def stanza_format(header=None, blank_lines=1):
+    """Return a corpus format for `stream_sonnets`: a function that takes an
+    iterator of lines and yields sonnets as lists of lines, with leading
+    spaces removed as in `load_shakespeare`.
+
+    If `header` (a compiled regex) is given, a sonnet starts after each line
+    it matches, and lines outside a sonnet are skipped. Otherwise any
+    non-blank line starts a sonnet. A sonnet ends after `blank_lines`
+    consecutive blank lines, at the next header, or at the end of the file.
+    Blank lines before the first line of a sonnet are skipped.
+    """
+    def parse(lines):
+        sonnet = None
+        blanks = 0
+        for line in lines:
+            if header is not None and header.match(line):
+                if sonnet:
+                    yield sonnet
+                sonnet, blanks = [], 0
+                continue
+
+            if not line.strip():
+                blanks += 1
+                if sonnet and blanks >= blank_lines:
+                    yield sonnet
+                    sonnet = None
+                continue
+
+            blanks = 0
+            if sonnet is None:
+                if header is not None:
+                    continue
+                sonnet = []
+            sonnet.append(LINE_PARSER.match(line).group('line'))
+        if sonnet:
+            yield sonnet
+    return parse
+
+# Formats of `stream_sonnets`. New formats can be added here, or a format
+# function passed to `stream_sonnets` directly.
+CORPUS_FORMATS = {
+    # Numbered sonnets separated by two blank lines, as in shakespeare.txt.
+    'shakespeare': stanza_format(re.compile(r'\s*[0-9]+\s*$'), blank_lines=2),
+    # Sonnets headed by roman numerals and ending at a blank line, as in
+    # spenser.txt.
+    'spenser': stanza_format(re.compile(r'\s*[IVXL]+\s*$'), blank_lines=1),
+    # Sonnets separated by blank lines, with no headers.
+    'stanzas': stanza_format(),
+}
+
+def open_text(path):
+    """Open a text file for reading, decompressing it if it is gzipped."""
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def stream_sonnets(paths, corpus_format='shakespeare'):
+    """Iterate over the sonnets of many corpus files, one line at a time,
+    so that no file is ever read into memory as a whole. Yields sonnets as
+    lists of lines, like `load_shakespeare`.
+
+    `paths` is a path or glob pattern, or a list of them; the files of a
+    pattern are read in sorted order. Files may be gzip-compressed.
+    `corpus_format` is a key of `CORPUS_FORMATS` or a function of the same
+    form (see `stanza_format`).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    parse = CORPUS_FORMATS[corpus_format] if isinstance(corpus_format, str) else corpus_format
+
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]:
+            with open_text(path) as f:
+                yield from parse(line.rstrip('\r\n') for line in f)
+
+# The syllable dictionary, loaded on the first call to `syllable_dic`.
+_syllable_dic = None
+
 def syllable_dic():
-    """Load Syllable_dictionary.txt. Returns a dictionary; keys are
-    words and values are syllables.    
+    """Return the syllable dictionary of Syllable_dictionary.txt; keys are
+    words and values are syllables. Words also appear with an "_e" suffix,
+    mapping to their syllables at the end of a line.
+
+    The dictionary is loaded on the first call and the same dictionary is
+    returned afterwards, so do not modify it. It is read from a pickled cache
+    next to the text file, which is rebuilt when the text file changes.
+    """
+    global _syllable_dic
+    if _syllable_dic is None:
+        _syllable_dic = load_syllable_cache(SYLLABLE_PATH, SYLLABLE_CACHE_PATH)
+    return _syllable_dic
+
+def syllable_index(obs_map):
+    """Index the syllable counts of the words of `obs_map`, a dictionary from
+    words to integer ids (e.g. the one built by `preprocessing`), so that
+    syllable queries are array lookups. Returns a dictionary with:
+
+    - 'words': list of the words; `words[i]` is the word of id `i`.
+    - 'counts': integer array; `counts[i]` is the number of syllables of
+      word `i`, or 0 if it is not in the syllable dictionary.
+    - 'end_counts': the same for word `i` at the end of a line.
+    - 'buckets': list; `buckets[k]` is an array of the ids of the words of
+      `k` syllables, in increasing order. `buckets[0]` holds unknown words.
+    - 'end_buckets': the same for the end-of-line counts.
+    """
+    dic = syllable_dic()
+    words = [None] * (max(obs_map.values()) + 1)
+    counts = np.zeros(len(words), dtype=int)
+    end_counts = np.zeros_like(counts)
+    for word, i in obs_map.items():
+        words[i] = word
+        counts[i] = dic.get(word, 0)
+        end_counts[i] = dic.get(word + '_e', 0)
+
+    def buckets(c):
+        order = np.argsort(c, kind='stable')
+        return np.split(order, np.cumsum(np.bincount(c))[:-1])
+
+    return {
+        'words': words,
+        'counts': counts,
+        'end_counts': end_counts,
+        'buckets': buckets(counts),
+        'end_buckets': buckets(end_counts),
+    }
+
+def load_syllable_cache(path, cache_path):
+    """Load the syllable dictionary of the text file at `path` through the
+    cache at `cache_path`, a pickle of the dictionary and the size, mtime and
+    SHA-1 of the text file it was built from.
+
+    The cache is used as is if the size and mtime match. Otherwise the hash
+    is compared, so that a file that was only touched does not need parsing.
+    If the hash differs too, the text file is parsed and the cache rewritten
+    (unless its directory is read-only). A cache that cannot be read is
+    treated as missing and rewritten.
+    """
+    stat = os.stat(path)
+    cache = None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['size'] == stat.st_size and cache['mtime'] == stat.st_mtime_ns:
+            return cache['dic']
+    except (pickle.UnpicklingError, EOFError, KeyError, TypeError, OSError):
+        cache = None
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    if cache is not None and cache.get('sha1') == digest:
+        dic = cache['dic']
+    else:
+        dic = parse_syllable_dic(path)
+    _save_syllable_cache(cache_path, dic, stat, digest)
+    return dic
+
+def _save_syllable_cache(cache_path, dic, stat, digest):
+    """Write the syllable cache read by `load_syllable_cache`. The cache is
+    written to a temporary file of its own and moved into place, so that
+    processes rebuilding it at the same time do not mix their writes.
+    """
+    cache = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha1': digest,
+        'dic': dic,
+    }
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        os.remove(tmp_path)
+
+def parse_syllable_dic(path=SYLLABLE_PATH):
+    """Parse a syllable dictionary in the format of Syllable_dictionary.txt.
+    Returns a dictionary; keys are words and values are syllables.
     """
-    f = open(SYLLABLE_PATH, 'r')
+    f = open(path, 'r')
     syllable_data = f.read()
     f.close()
 